@@ -1,12 +1,16 @@
 import os
-import json
+import hmac
+import time
+import logging
+import asyncio
 import uuid
-import requests
-from datetime import datetime, timezone
-from aiohttp import web, ClientSession
-from pydantic import BaseModel
+import httpx
+import orjson
+import msgspec
+from aiohttp import web
 from pathlib import Path
-from requests.exceptions import RequestException
+
+logger = logging.getLogger(__name__)
 
 class CopilotClientError(Exception):
     """Base exception for all client-related errors."""
@@ -29,18 +33,33 @@ class Headers:
         "editor-version": "vscode/1.83.0",
     }
 
-class HostsData(BaseModel):
+# Static headers merged once at import time
+_AUTH_BASE_REFRESH = {"Accept": "application/json", **Headers.AUTH}
+
+_PROXY_HEADER_TEMPLATE = {
+    "Content-Type": "application/json",
+    "Copilot-Integration-Id": "vscode-chat",
+    "openai-organization": "github-copilot",
+    "openai-intent": "conversation-panel",
+    **Headers.AUTH,
+}
+
+class HostEntry(msgspec.Struct, frozen=True):
+    oauth_token: str
+
+class HostsData(msgspec.Struct, frozen=True):
     github_oauth_token: str
 
     @classmethod
     def from_file(cls, file_path: Path) -> "HostsData":
         hosts_file = Path(file_path)
-        hosts_data = json.loads(hosts_file.read_text())
+        # Decode only oauth_token; msgspec skips the other fields
+        hosts_data = msgspec.json.decode(hosts_file.read_bytes(), type=dict[str, HostEntry])
         for key, value in hosts_data.items():
             if "github.com" in key:
-                return cls(github_oauth_token=value["oauth_token"])
+                return cls(github_oauth_token=value.oauth_token)
             
-class CopilotToken(BaseModel):
+class CopilotToken(msgspec.Struct, frozen=True):
     """
     Represents a GitHub Copilot authentication token and its associated metadata.
     """
@@ -77,12 +96,30 @@ class GithubCopilotClient:
 
     def __init__(self) -> None:
         self._oauth_token: str | None = None
+        self._oauth_path: Path | None = None
         self._copilot_token: CopilotToken | None = None
         self._machine_id: str = str(uuid.uuid4())
         self._session_id: str = ""
+        self._expires_at: int = 0
+        self._base_headers: dict[str, str] = {}
+        # In-flight refresh shared by every coroutine that finds the token expired
+        self._refresh_task: asyncio.Task | None = None
 
         self._load_cached_token()
 
+    def _set_copilot_token(self, copilot_token: CopilotToken) -> None:
+        """
+        Stores the Copilot token and precomputes the per-token request headers.
+        """
+        self._copilot_token = copilot_token
+        # Refresh 30 seconds early so the token does not expire mid-request
+        self._expires_at = copilot_token.expires_at - 30
+        headers = _PROXY_HEADER_TEMPLATE.copy()
+        headers["vscode-machineid"] = self._machine_id
+        headers["vscode-sessionid"] = self._session_id
+        headers["Authorization"] = f"Bearer {copilot_token.token}"
+        self._base_headers = headers
+
     def _load_cached_token(self) -> None:
         """
         Attempts to load a cached Copilot token.
@@ -90,13 +127,22 @@ class GithubCopilotClient:
         cache_path = Path("/tmp/copilot_token.json")
         if cache_path.exists():
             try:
-                token_data = json.loads(cache_path.read_text())
-                self._copilot_token = CopilotToken(**token_data)
-            except (json.JSONDecodeError, TypeError):
+                self._set_copilot_token(msgspec.json.decode(cache_path.read_bytes(), type=CopilotToken))
+            except msgspec.DecodeError:
                 cache_path.unlink(missing_ok=True)
 
     def _load_oauth_token(self) -> str:
         """Loads the OAuth token from the GitHub Copilot configuration."""
+        if self._oauth_path is not None:
+            # Read the previously successful config file; rescan if that fails
+            try:
+                host_data = HostsData.from_file(self._oauth_path)
+                if host_data and host_data.github_oauth_token:
+                    return host_data.github_oauth_token
+            except (FileNotFoundError, msgspec.DecodeError):
+                pass
+            self._oauth_path = None
+
         config_dir = os.getenv("XDG_CONFIG_HOME", Path.home() / ".config")
 
         files = [
@@ -109,8 +155,9 @@ class GithubCopilotClient:
                 try:
                     host_data = HostsData.from_file(file)
                     if host_data and host_data.github_oauth_token:
+                        self._oauth_path = file
                         return host_data.github_oauth_token
-                except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                except (FileNotFoundError, msgspec.DecodeError):
                     raise AuthenticationError("GitHub Copilot configuration not found or invalid.")
 
         raise AuthenticationError("OAuth token not found in GitHub Copilot configuration.")
@@ -124,68 +171,83 @@ class GithubCopilotClient:
             self._oauth_token = self._load_oauth_token()
         return self._oauth_token
 
-    def _refresh_copilot_token(self) -> None:
+    async def _refresh_copilot_token(self, client: httpx.AsyncClient) -> None:
         """Refreshes the Copilot token using the OAuth token."""
-        self._session_id = f"{uuid.uuid4()}{int(datetime.now(timezone.utc).timestamp() * 1000)}"
+        self._session_id = f"{uuid.uuid4().hex}{int(time.time() * 1000)}"
 
-        headers = {
-            "Authorization": f"token {self._get_oauth_token()}",
-            "Accept": "application/json",
-            **Headers.AUTH,
-        }
+        headers = {"Authorization": f"token {self._get_oauth_token()}", **_AUTH_BASE_REFRESH}
 
         try:
-            response = requests.get(APIEndpoints.TOKEN, headers=headers, timeout=10)
+            response = await client.get(APIEndpoints.TOKEN, headers=headers, timeout=10)
+            if response.status_code == 401:
+                # OAuth token rejected; reload it from the remembered config file next time
+                self._oauth_token = None
             response.raise_for_status()
-            token_data = response.json()
+            raw = response.content
 
-            self._copilot_token = CopilotToken(**token_data)
+            self._set_copilot_token(msgspec.json.decode(raw, type=CopilotToken))
 
-            # Cache the token
+            # Cache the raw response; it already decoded into a CopilotToken, so no re-encode is needed
             cache_path = Path("/tmp/copilot_token.json")
-            _ = cache_path.write_text(json.dumps(token_data))
+            _ = cache_path.write_bytes(raw)
 
-        except RequestException as e:
+        except (httpx.HTTPError, msgspec.DecodeError) as e:
             raise APIError(f"Failed to refresh Copilot token: {str(e)}") from e
 
-    def _ensure_valid_token(self) -> None:
+    async def _refresh_once(self, client: httpx.AsyncClient) -> None:
         """
-        Ensures a valid Copilot token is available.
+        Runs a single token refresh whose outcome is shared by all concurrent waiters.
         """
+        try:
+            await self._refresh_copilot_token(client)
+        finally:
+            self._refresh_task = None
 
-        current_time = int(datetime.now(timezone.utc).timestamp())
+    async def _ensure_valid_token(self, client: httpx.AsyncClient) -> None:
+        """
+        Ensures a valid Copilot token is available.
+        """
 
-        if not self._copilot_token or current_time >= self._copilot_token.expires_at:
-            self._refresh_copilot_token()
+        if time.time() >= self._expires_at:
+            if self._refresh_task is None:
+                self._refresh_task = asyncio.ensure_future(self._refresh_once(client))
+            # Shield so a cancelled waiter does not cancel the refresh for everyone else
+            await asyncio.shield(self._refresh_task)
 
         if not self._copilot_token:
             raise AuthenticationError("Failed to obtain Copilot token")
 
-    def get_headers(self):
-        self._ensure_valid_token()
-
-        return {
-            "Content-Type": "application/json",
-            "x-request-id": str(uuid.uuid4()),
-            "vscode-machineid": self._machine_id,
-            "vscode-sessionid": self._session_id,
-            "Authorization": f"Bearer {self._copilot_token.token}",
-            "Copilot-Integration-Id": "vscode-chat",
-            "openai-organization": "github-copilot",
-            "openai-intent": "conversation-panel",
-            **Headers.AUTH,
-        }
+    async def get_headers(self, client: httpx.AsyncClient):
+        await self._ensure_valid_token(client)
+
+        headers = self._base_headers.copy()
+        headers["x-request-id"] = os.urandom(16).hex()
+        return headers
     
 copilotclient = GithubCopilotClient()
+
+# 不向下游转发的上游响应头：逐跳头部，以及由 aiohttp 重新生成的长度/编码头部
+# (httpx 会解压上游 body，因此 Content-Encoding 也不能原样转发)
+_HOP_BY_HOP = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "content-length",
+    "content-encoding",
+})
+
 token = os.getenv("TOKEN", "your_default_token")  # 从环境变量中获取 token，或使用默认值
+_EXPECTED_AUTH = f"Bearer {token}".encode()
 
 async def proxy_handler(request):
     # 添加 Bearer Token 认证
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return web.Response(status=401, text="Unauthorized")
-
-    if auth_header[len("Bearer "):].strip() != token:
+    auth_header = request.headers.get("Authorization", "").encode("utf-8", "surrogateescape")
+    if len(auth_header) != len(_EXPECTED_AUTH) or not hmac.compare_digest(auth_header, _EXPECTED_AUTH):
         return web.Response(status=401, text="Unauthorized")
     
     # 获取目标路径
@@ -195,47 +257,81 @@ async def proxy_handler(request):
     # 获取请求方法、头部和数据
     method = request.method
     # headers = {key: value for key, value in request.headers.items()}
-    headers = copilotclient.get_headers()
+    client = request.app["httpx"]
+    headers = await copilotclient.get_headers(client)
     # headers["Host"] = "api.githubcopilot.com"  # 设置 Host 头部
     body = await request.read()
 
-    # 根据 Content-Type 动态处理 body
-    content_type = headers.get("Content-Type", "")
-    request_kwargs = {"method": method, "url": target_url, "headers": headers}
+    # 根据客户端请求的 Content-Type 判断是否需要解析 body
+    # body 原样透传，JSON 只解析一次用于读取请求参数
+    is_stream = False
 
-    if "application/json" in content_type:
-        request_kwargs["json"] = await request.json()
-    elif "application/x-www-form-urlencoded" in content_type or "multipart/form-data" in content_type:
-        request_kwargs["data"] = body
-    else:
-        request_kwargs["data"] = body  # 默认处理为原始数据
-
-    async with ClientSession() as session:
-        async with session.request(**request_kwargs) as response:
+    if body and request.content_type == "application/json":
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            payload = None
+        is_stream = isinstance(payload, dict) and bool(payload.get("stream", False))
+
+    # 通过 HTTP/2 客户端转发，所有请求复用同一条上游连接
+    stream_resp = None
+    try:
+        async with client.stream(method, target_url, headers=headers, content=body) as response:
             # 检查是否需要流式传输
-            if request_kwargs["json"]['stream']:
-                async def stream_response():
-                    async for chunk in response.content.iter_chunked(1024):
-                        yield chunk
-
+            if is_stream:
+                stream_headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP}
                 stream_resp = web.StreamResponse(
-                    status=response.status,
-                    headers=response.headers,
+                    status=response.status_code,
+                    headers=stream_headers,
                 )
                 await stream_resp.prepare(request)  # Await the prepare coroutine
-                async for chunk in stream_response():
+                # 按上游到达的数据块直接转发，不再切成固定大小
+                async for chunk in response.aiter_bytes():
                     await stream_resp.write(chunk)  # Write chunks to the response
                 return stream_resp
-            
-            # 处理非流式响应
-            response_json = await response.json()
-            print(response_json)
-            return web.json_response(response_json, status=response.status)
+
+            # 处理非流式响应：原样返回上游 body 和状态码
+            raw = await response.aread()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("resp=%s", raw)
+            resp_headers = {}
+            upstream_content_type = response.headers.get("Content-Type")
+            if upstream_content_type:
+                # 包含 charset 时不能用 content_type 参数，直接透传头部
+                resp_headers["Content-Type"] = upstream_content_type
+            return web.Response(body=raw, status=response.status_code, headers=resp_headers)
+    except httpx.HTTPError as e:
+        logger.warning("Upstream request to %s failed: %s", target_url, e)
+        if stream_resp is not None and stream_resp.prepared:
+            # 响应头已发送，重新抛出异常以断开连接，让客户端感知流被截断
+            raise
+        return web.Response(status=502, text="Bad Gateway")
+
+
+async def init_client(app):
+    # 共享的 HTTP/2 客户端：转发到 api.githubcopilot.com 的请求多路复用同一连接，
+    # token 刷新 (api.github.com) 也复用该客户端
+    app["httpx"] = httpx.AsyncClient(
+        http2=True,
+        # 补全可能较慢，读超时与 aiohttp 默认的 300 秒保持一致
+        timeout=httpx.Timeout(30.0, read=300.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+
+
+async def close_client(app):
+    await app["httpx"].aclose()
 
 
 # 创建 aiohttp 应用
 app = web.Application()
+app.on_startup.append(init_client)
+app.on_cleanup.append(close_client)
 app.router.add_route("*", "/{path:.*}", proxy_handler)
 
 if __name__ == "__main__":
-    web.run_app(app, host="0.0.0.0", port=80)
\ No newline at end of file
+    # 使用 uvloop 事件循环，并关闭逐请求的访问日志
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    web.run_app(app, host="0.0.0.0", port=80, access_log=None)
\ No newline at end of file